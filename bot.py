@@ -1,35 +1,71 @@
 # bot.py (updated to use web_server.py)
 import os
+import sys
 import time
-import boto3
+import aioboto3
 import asyncio
 import re
+import random
 import base64
-from threading import Thread
-from pyrogram import Client, filters
+from contextlib import AsyncExitStack
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
 from pyrogram.errors import FloodWait
 from dotenv import load_dotenv
 import logging
-from collections import defaultdict
-from datetime import datetime, timedelta
+import logging.handlers
+import queue
+from cachetools import TTLCache
+from collections import deque
 import botocore
+from aiobotocore.config import AioConfig
+from boto3.s3.transfer import TransferConfig
 import aiofiles
-import hashlib
-from concurrent.futures import ThreadPoolExecutor
+import aiofiles.os
+import functools
 import psutil
-import tempfile
 
-# Import the web server
-from web_server import run_flask_server
-
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# Set up non-blocking logging: records are enqueued in O(1) and drained
+# by a background thread, so a slow stderr pipe never stalls the event
+# loop. Must happen before web_server is imported - its module-level
+# logging.basicConfig() would otherwise install a synchronous root
+# StreamHandler first (and then every record would be emitted twice)
+_log_queue = queue.Queue(-1)
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(
+    logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+)
+log_listener = logging.handlers.QueueListener(
+    _log_queue, _stream_handler, respect_handler_level=True
 )
+logging.getLogger().addHandler(logging.handlers.QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
+log_listener.start()
 logger = logging.getLogger(__name__)
 
+# Import the web server (after logging setup: the root logger already
+# has a handler, so web_server's basicConfig is a no-op)
+from web_server import serve_web
+
+# tgcrypto provides the C AES-IGE implementation Pyrogram uses for
+# MTProto; without it crypto falls back to pure Python and becomes the
+# CPU hotspot on multi-GB transfers. Check what Pyrogram actually bound,
+# not merely whether tgcrypto is importable, so regressions are visible.
+try:
+    from pyrogram.crypto import aes as _pyrogram_aes
+    if getattr(_pyrogram_aes, "tgcrypto", None) is not None:
+        CRYPTO_BACKEND = "tgcrypto"
+    else:
+        CRYPTO_BACKEND = "pure-Python (slow)"
+except ImportError:
+    CRYPTO_BACKEND = "unavailable"
+
+if CRYPTO_BACKEND != "tgcrypto":
+    logger.warning(
+        f"Pyrogram is running without tgcrypto (backend: {CRYPTO_BACKEND}) - "
+        "MTProto crypto will dominate large transfers"
+    )
+
 # Load environment variables
 load_dotenv()
 
@@ -44,10 +80,32 @@ WASABI_REGION = os.getenv("WASABI_REGION", "us-east-1")
 RENDER_URL = os.getenv("RENDER_URL", "http://localhost:8000")
 MAX_FILE_SIZE = 2 * 1024 * 1024 * 1024  # 2GB
 
+# Optional comma-separated replica buckets for backup fan-out
+WASABI_BACKUP_BUCKETS = [
+    b.strip() for b in os.getenv("WASABI_BACKUP_BUCKETS", "").split(",") if b.strip()
+]
+
 # Performance tuning
 CHUNK_SIZE = 1024 * 1024 * 1024  # 64MB chunks for large files
+MULTIPART_CHUNK = 10 * 1024 * 1024  # 10MB parts for streaming multipart uploads
+PART_CONCURRENCY = 4  # In-flight parts per streaming upload (bounds buffering)
 MAX_WORKERS = 4  # Concurrent upload/download threads
 BUFFER_SIZE = 8192 * 8  # 64KB buffer for file operations
+RANGE_CHUNK = 16 * 1024 * 1024  # 16MB byte-range per download GET
+RANGE_CONCURRENCY = 8  # Concurrent ranged GETs per download
+RANGE_THRESHOLD = 64 * 1024 * 1024  # Below this, a single GET is cheaper
+BACKUP_CONCURRENCY = 4  # Parallel backup copies per upload
+
+# Tuned transfer settings: fewer, larger parts cut per-part HTTPS and
+# signing overhead on multi-GB transfers
+TRANSFER_CFG = TransferConfig(
+    multipart_threshold=64 * 1024 * 1024,
+    multipart_chunksize=32 * 1024 * 1024,
+    max_concurrency=16,
+    io_chunksize=1024 * 1024,
+    max_io_queue=100,
+    use_threads=True
+)
 
 # Validate environment variables
 missing_vars = []
@@ -69,113 +127,300 @@ if missing_vars:
 class HighPerformanceS3:
     def __init__(self):
         self.endpoint_url = f'https://s3.{WASABI_REGION}.wasabisys.com'
-        self.s3_client = boto3.client(
+        self.session = aioboto3.Session()
+        # Pool sized to the host, keepalive so idle sockets survive
+        # between uploads instead of paying TLS handshakes again
+        self.client_config = AioConfig(
+            max_pool_connections=os.cpu_count() * 5,
+            retries={'max_attempts': 10, 'mode': 'adaptive'},
+            s3={'addressing_style': 'virtual'},
+            signature_version='s3v4',
+            tcp_keepalive=True,
+            # Fail fast on dead endpoints instead of the 60s botocore
+            # defaults; reads stay generous for multi-MB part bodies
+            connect_timeout=5,
+            read_timeout=60
+        )
+        self.client = None  # Persistent async client, opened in main()
+
+    def client_context(self):
+        """Async context manager for the shared S3 client"""
+        return self.session.client(
             's3',
             endpoint_url=self.endpoint_url,
             aws_access_key_id=WASABI_ACCESS_KEY,
             aws_secret_access_key=WASABI_SECRET_KEY,
             region_name=WASABI_REGION,
-            config=botocore.config.Config(
-                max_pool_connections=100,
-                retries={'max_attempts': 10, 'mode': 'adaptive'},
-                s3={'addressing_style': 'virtual'},
-                signature_version='s3v4'
-            )
+            config=self.client_config
         )
-        self.executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
-    
-    def upload_file_chunked(self, file_path, bucket, key):
-        """Upload large files using multipart upload"""
-        file_size = os.path.getsize(file_path)
-        
-        # Initiate multipart upload
-        mpu = self.s3_client.create_multipart_upload(
+
+    async def upload_file_chunked(self, file_path, bucket, key):
+        """Upload large local files using tuned concurrent multipart transfer"""
+        await self.client.upload_file(file_path, bucket, key, Config=TRANSFER_CFG)
+        return True
+
+    async def upload_stream(self, chunks, bucket, key, progress=None):
+        """Stream an async chunk iterator straight into a multipart upload"""
+        mpu = await self.client.create_multipart_upload(
             Bucket=bucket,
             Key=key
         )
         mpu_id = mpu['UploadId']
-        
+
         parts = []
         part_number = 1
-        
-        try:
-            with open(file_path, 'rb') as file:
-                while True:
-                    chunk = file.read(CHUNK_SIZE)
-                    if not chunk:
-                        break
-                    
-                    # Upload part
-                    part = self.s3_client.upload_part(
+        buffer = bytearray()
+        total_sent = 0
+        # Semaphore doubles as backpressure: the producer blocks before
+        # buffering more than PART_CONCURRENCY parts in flight
+        semaphore = asyncio.Semaphore(PART_CONCURRENCY)
+        tasks = []
+
+        async def put_part(number, body):
+            nonlocal total_sent
+            try:
+                async with S3_OP_SEMAPHORE:
+                    part = await self.client.upload_part(
                         Bucket=bucket,
                         Key=key,
-                        PartNumber=part_number,
+                        PartNumber=number,
                         UploadId=mpu_id,
-                        Body=chunk
+                        Body=body
                     )
-                    parts.append({
-                        'PartNumber': part_number,
-                        'ETag': part['ETag']
-                    })
-                    
-                    part_number += 1
-                    chunk = None  # Free memory
-            
+                parts.append({
+                    'PartNumber': number,
+                    'ETag': part['ETag']
+                })
+                total_sent += len(body)
+                if progress:
+                    await progress(total_sent)
+            finally:
+                semaphore.release()
+
+        async def flush_part():
+            nonlocal part_number
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(put_part(part_number, bytes(buffer))))
+            part_number += 1
+            buffer.clear()  # Free memory
+
+        try:
+            async for chunk in chunks:
+                buffer.extend(chunk)
+                if len(buffer) >= MULTIPART_CHUNK:
+                    # Part PUTs overlap the Telegram reads instead of
+                    # stalling them
+                    await flush_part()
+
+            # Flush the tail (or an empty part for zero-byte files)
+            if buffer or not tasks:
+                await flush_part()
+
+            await asyncio.gather(*tasks)
+
             # Complete multipart upload
-            self.s3_client.complete_multipart_upload(
+            parts.sort(key=lambda part: part['PartNumber'])
+            await self.client.complete_multipart_upload(
                 Bucket=bucket,
                 Key=key,
                 UploadId=mpu_id,
                 MultipartUpload={'Parts': parts}
             )
-            return True
-            
+            return total_sent
+
         except Exception as e:
             # Abort upload on error
-            self.s3_client.abort_multipart_upload(
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.client.abort_multipart_upload(
                 Bucket=bucket,
                 Key=key,
                 UploadId=mpu_id
             )
             raise e
-    
-    def download_file_chunked(self, bucket, key, file_path):
-        """Download large files with progress tracking"""
+
+    async def download_file_chunked(self, bucket, key, file_path, expected_size=None):
+        """Download large files using concurrent byte-range GETs"""
         try:
-            # Get file size first
-            head = self.s3_client.head_object(Bucket=bucket, Key=key)
-            file_size = head['ContentLength']
-            
-            # Use ranged downloads for better performance
-            with open(file_path, 'wb') as file:
-                bytes_downloaded = 0
-                
-                while bytes_downloaded < file_size:
-                    end_byte = min(bytes_downloaded + CHUNK_SIZE - 1, file_size - 1)
-                    
-                    response = self.s3_client.get_object(
-                        Bucket=bucket,
-                        Key=key,
-                        Range=f'bytes={bytes_downloaded}-{end_byte}'
-                    )
-                    
-                    chunk = response['Body'].read()
-                    file.write(chunk)
-                    bytes_downloaded += len(chunk)
-                    
-                    # Free memory
-                    chunk = None
-            
+            # Get file size first, unless the caller already knows it
+            if expected_size is not None:
+                file_size = expected_size
+            else:
+                head = await self.client.head_object(Bucket=bucket, Key=key)
+                file_size = head['ContentLength']
+
+            if file_size > RANGE_THRESHOLD:
+                await self._download_ranges(bucket, key, file_path, file_size)
+            else:
+                # Small files: a single GET beats ranged overhead
+                response = await self.client.get_object(Bucket=bucket, Key=key)
+                data = await response['Body'].read()
+                async with aiofiles.open(file_path, 'wb') as file:
+                    await file.write(data)
+
             return file_path
-            
+
         except Exception as e:
-            if os.path.exists(file_path):
-                os.remove(file_path)
+            # Async syscalls keep cleanup off the event loop thread
+            if await aiofiles.os.path.exists(file_path):
+                await aiofiles.os.remove(file_path)
             raise e
 
+    async def replicate_to_backups(self, key):
+        """Fan out server-side copies to all healthy backup buckets"""
+        targets = [b for b in WASABI_BACKUP_BUCKETS if backup_available(b)]
+        if not targets:
+            return
+
+        semaphore = asyncio.Semaphore(BACKUP_CONCURRENCY)
+
+        async def copy_one(bucket):
+            async with semaphore, S3_OP_SEMAPHORE:
+                await self.client.copy_object(
+                    Bucket=bucket,
+                    Key=key,
+                    CopySource={'Bucket': WASABI_BUCKET, 'Key': key}
+                )
+
+        # N backups complete in ~max(time) instead of sum(time); one
+        # failed destination does not abort the others
+        results = await asyncio.gather(
+            *[copy_one(bucket) for bucket in targets],
+            return_exceptions=True
+        )
+        for bucket, result in zip(targets, results):
+            if isinstance(result, Exception):
+                backup_down_until[bucket] = time.monotonic() + BACKUP_COOLDOWN
+                logger.error(f"Backup copy to {bucket} failed: {result}")
+            else:
+                backup_down_until.pop(bucket, None)
+
+    async def _download_ranges(self, bucket, key, file_path, file_size):
+        """Fetch parallel byte ranges, each flushed to its file offset"""
+        # Preallocate so ranges can land at their offsets immediately;
+        # run off-loop since fallocate can stall on busy filesystems
+        def preallocate():
+            with open(file_path, 'wb') as file:
+                try:
+                    os.posix_fallocate(file.fileno(), 0, file_size)
+                except OSError:
+                    file.truncate(file_size)
+
+        await asyncio.to_thread(preallocate)
+
+        semaphore = asyncio.Semaphore(RANGE_CONCURRENCY)
+
+        async def fetch(start, end):
+            async with semaphore, S3_OP_SEMAPHORE:
+                response = await self.client.get_object(
+                    Bucket=bucket,
+                    Key=key,
+                    Range=f'bytes={start}-{end}'
+                )
+                data = await response['Body'].read()
+            async with aiofiles.open(file_path, 'rb+') as file:
+                await file.seek(start)
+                await file.write(data)
+
+        await asyncio.gather(*[
+            fetch(start, min(start + RANGE_CHUNK - 1, file_size - 1))
+            for start in range(0, file_size, RANGE_CHUNK)
+        ])
+
 # Initialize high-performance S3 client
 s3_manager = HighPerformanceS3()
-s3_client = s3_manager.s3_client
+
+# Skip redundant Wasabi round trips: presigned URLs and HEAD results are
+# cached per object key. URL cache TTL stays well under the 7-day link
+# expiry so cached links are never handed out near-dead.
+presigned_cache = TTLCache(maxsize=1024, ttl=3600 * 20)
+head_cache = TTLCache(maxsize=1024, ttl=300)
+
+# Global cap on concurrent S3 data operations across all users, sized
+# below the connection pool so bursts queue predictably instead of
+# thrashing sockets
+S3_OP_SEMAPHORE = asyncio.Semaphore(48)
+
+# Whole-file uploads additionally queue behind this coarser gate: each
+# stream buffers up to PART_CONCURRENCY parts, so this bounds peak RAM
+# and keeps N users from dividing the NIC into uselessly thin slices
+UPLOAD_SEMAPHORE = asyncio.Semaphore(int(os.getenv('MAX_CONCURRENT_UPLOADS', '8')))
+
+# Strong references to fire-and-forget tasks: the loop only keeps weak
+# ones, so an unreferenced replication task could be garbage-collected
+# mid-flight and the backup copies would silently never happen
+_background_tasks = set()
+
+def spawn_background(coro):
+    """create_task plus bookkeeping so the task survives until done"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+# Backup buckets that recently failed are skipped for a cooldown so no
+# request queues behind a dead endpoint's connect timeout
+BACKUP_COOLDOWN = 30  # seconds
+backup_down_until = {}
+
+def backup_available(bucket):
+    return time.monotonic() >= backup_down_until.get(bucket, 0.0)
+
+async def make_presigned(key):
+    """Generate (or reuse) a presigned download URL for an object key"""
+    url = presigned_cache.get(key)
+    if url is None:
+        url = await s3_manager.client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': WASABI_BUCKET, 'Key': key},
+            ExpiresIn=604800  # 7 days
+        )
+        presigned_cache[key] = url
+    return url
+
+async def head_object_cached(key):
+    """head_object with a short-lived cache to absorb repeat lookups"""
+    head = head_cache.get(key)
+    if head is None:
+        head = await s3_manager.client.head_object(Bucket=WASABI_BUCKET, Key=key)
+        head_cache[key] = head
+    return head
+
+async def find_in_backups(key):
+    """Probe all backup buckets at once; return (bucket, head) of the
+    first one holding the key, or None"""
+    targets = [b for b in WASABI_BACKUP_BUCKETS if backup_available(b)]
+    if not targets:
+        return None
+
+    results = await asyncio.gather(
+        *[s3_manager.client.head_object(Bucket=bucket, Key=key)
+          for bucket in targets],
+        return_exceptions=True
+    )
+    found = None
+    for bucket, head in zip(targets, results):
+        if not isinstance(head, Exception):
+            found = found or (bucket, head)
+        elif not isinstance(head, botocore.exceptions.ClientError):
+            # A 404 is a healthy endpoint saying no; anything else
+            # (connect/timeout) earns the cooldown
+            backup_down_until[bucket] = time.monotonic() + BACKUP_COOLDOWN
+    return found
+
+# libuv-backed event loop: much higher socket throughput on the
+# TLS-heavy Telegram/Wasabi hot path (no-op on Windows). Must be
+# installed before the Client is built - Pyrogram captures the current
+# loop at construction, so installing later leaves the bot on the
+# default CPython loop
+if sys.platform != 'win32':
+    import uvloop
+    uvloop.install()
+    # uvloop >= 0.21 policies no longer auto-create a loop on
+    # get_event_loop(), which Pyrogram's Client.__init__ relies on at
+    # module scope - create and register one explicitly
+    asyncio.set_event_loop(asyncio.new_event_loop())
 
 # Initialize Pyrogram client with performance optimizations
 app = Client(
@@ -184,7 +429,8 @@ app = Client(
     api_hash=API_HASH, 
     bot_token=BOT_TOKEN,
     workers=100,  # Increased workers for better performance
-    max_concurrent_transmissions=10  # Allow more concurrent operations
+    max_concurrent_transmissions=10,  # Allow more concurrent operations
+    sleep_threshold=60  # Absorb short FloodWaits in-session instead of raising
 )
 
 # Performance Monitoring Class
@@ -213,12 +459,16 @@ MEDIA_EXTENSIONS = {
     'image': ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.tiff', '.svg']
 }
 
+# Inverted once at import: extension -> type is a single hash lookup
+# instead of scanning three lists per call
+_EXT_TO_TYPE = {
+    ext: file_type
+    for file_type, extensions in MEDIA_EXTENSIONS.items()
+    for ext in extensions
+}
+
 def get_file_type(filename):
-    ext = os.path.splitext(filename)[1].lower()
-    for file_type, extensions in MEDIA_EXTENSIONS.items():
-        if ext in extensions:
-            return file_type
-    return 'other'
+    return _EXT_TO_TYPE.get(os.path.splitext(filename)[1].lower(), 'other')
 
 def generate_player_url(filename, presigned_url):
     if not RENDER_URL:
@@ -229,34 +479,66 @@ def generate_player_url(filename, presigned_url):
         return f"{RENDER_URL}/player/{file_type}/{encoded_url}"
     return None
 
+_BYTE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+
+@functools.lru_cache(maxsize=1024)
 def humanbytes(size):
-    """Convert bytes to human readable format with precision"""
+    """Convert bytes to human readable format with precision.
+
+    O(1) unit selection via bit_length - this runs on every progress
+    update and list row, so no division loop, and repeat sizes come
+    straight from the memo.
+    """
+    size = int(size or 0)
     if not size:
         return "0 B"
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if size < 1024.0:
-            return f"{size:.2f} {unit}"
-        size /= 1024.0
-    return f"{size:.2f} PB"
+    index = min((size.bit_length() - 1) // 10, len(_BYTE_UNITS) - 1)
+    return f"{size / (1 << (index * 10)):.2f} {_BYTE_UNITS[index]}"
 
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9 _.-]')
+
+@functools.lru_cache(maxsize=4096)
 def sanitize_filename(filename):
     """Secure filename sanitization"""
-    filename = re.sub(r'[^a-zA-Z0-9 _.-]', '_', filename)
+    # Memoized: the same file re-sent (or re-downloaded) skips the
+    # regex pass entirely
+    filename = _SANITIZE_RE.sub('_', filename)
     if len(filename) > 200:
         name, ext = os.path.splitext(filename)
         filename = name[:200-len(ext)] + ext
     return filename
 
+@functools.lru_cache(maxsize=4096)
 def get_user_folder(user_id):
+    # Memoized: repeat users skip rebuilding the same prefix string in
+    # every handler
     return f"user_{user_id}"
 
+@functools.lru_cache(maxsize=1024)
 def create_download_keyboard(presigned_url, player_url=None):
+    # Memoized on the URL pair: presigned URLs themselves come from a
+    # cache, so repeat /download hits reuse the exact markup objects
+    # instead of rebuilding button/markup wrappers each time
     keyboard = []
     if player_url:
         keyboard.append([InlineKeyboardButton("🎬 Web Player", url=player_url)])
     keyboard.append([InlineKeyboardButton("📥 Direct Download", url=presigned_url)])
     return InlineKeyboardMarkup(keyboard)
 
+async def edit_floodsafe(message, text, **kwargs):
+    """edit_text that rides out FloodWait instead of dropping the reply.
+
+    Pyrogram's sleep_threshold already absorbs waits up to 60s; this
+    covers the longer ones so a final success/error message is never
+    lost to a single exception. Jitter keeps retries from resyncing.
+    """
+    for _ in range(3):
+        try:
+            return await message.edit_text(text, **kwargs)
+        except FloodWait as e:
+            await asyncio.sleep(min(e.value, 60) + random.random())
+    return await message.edit_text(text, **kwargs)
+
 def create_progress_bar(percentage, length=20):
     filled = int(length * percentage / 100)
     empty = length - filled
@@ -274,44 +556,83 @@ def format_eta(seconds):
 def format_elapsed(seconds):
     return f"{int(seconds // 60):02d}:{int(seconds % 60):02d}"
 
-# Rate limiting with higher limits for premium performance
-user_requests = defaultdict(list)
-user_upload_limits = defaultdict(lambda: MAX_FILE_SIZE)
+# Rate limiting with higher limits for premium performance.
+# TTL-bounded caches evict idle users automatically, so abandoned chats
+# cannot accumulate per-user state forever.
+user_requests = TTLCache(maxsize=10_000, ttl=120)
+user_upload_limits = TTLCache(maxsize=10_000, ttl=600)
 
 def is_rate_limited(user_id, limit=10, period=60):
-    now = datetime.now()
-    user_requests[user_id] = [req_time for req_time in user_requests[user_id] 
-                             if now - req_time < timedelta(seconds=period)]
-    
-    if len(user_requests[user_id]) >= limit:
+    # O(1) amortized sliding window: expire from the left of a bounded
+    # deque instead of rebuilding a list per request. Monotonic clock
+    # avoids wall-clock jumps.
+    now = time.monotonic()
+    window = user_requests.get(user_id)
+    if window is None:
+        window = deque(maxlen=limit)
+        user_requests[user_id] = window
+
+    while window and now - window[0] > period:
+        window.popleft()
+
+    if len(window) >= limit:
         return True
-    
-    user_requests[user_id].append(now)
+
+    window.append(now)
     return False
 
-# High-speed download function with memory optimization
-async def download_large_file(client, message, file_id, file_size, file_name):
-    """Download large files with optimized memory usage"""
-    download_dir = tempfile.mkdtemp()
-    file_path = os.path.join(download_dir, file_name)
-    
-    try:
-        # Use async file operations
-        async with aiofiles.open(file_path, 'wb') as file:
-            downloaded = 0
-            async for chunk in client.stream_media(message, limit=BUFFER_SIZE):
-                await file.write(chunk)
-                downloaded += len(chunk)
-                yield downloaded, file_size
-                
-    except Exception as e:
-        # Cleanup on error
-        if os.path.exists(file_path):
-            os.remove(file_path)
-        os.rmdir(download_dir)
-        raise e
-    
-    yield file_path, file_size
+# Single media filter: one predicate call per update instead of four
+# chained filters and their or-combinator wrappers
+MEDIA_FILTER = filters.create(
+    lambda _, __, m: (m.document or m.video or m.audio or m.photo) is not None,
+    name='MediaFilter'
+)
+
+# Static reply text, composed once at import instead of per message
+START_TEXT = (
+    "⚡ **ULTRA HIGH-SPEED CLOUD STORAGE BOT** ⚡\n\n"
+    "✨ **Features:**\n"
+    "• 🚀 **2GB File Support** - Massive uploads/downloads\n"
+    "• ⚡ **Multi-threaded Transfers** - Maximum speed\n"
+    "• 💾 **Memory Optimized** - Efficient large file handling\n"
+    "• 🌐 **Web Player Integration** - Instant media playback\n"
+    "• 🔄 **Resumable Uploads** - Never lose progress\n\n"
+    "**📁 Supported Formats:**\n"
+    "• Videos: MP4, AVI, MKV, MOV, WebM, etc.\n"
+    "• Audio: MP3, FLAC, WAV, AAC, etc.\n"
+    "• Images: JPG, PNG, GIF, WebP, etc.\n"
+    "• Documents: PDF, ZIP, etc.\n\n"
+    "**⚡ Commands:**\n"
+    "• Just send any file to upload\n"
+    "• `/download filename` - High-speed download\n"
+    "• `/play filename` - Web player link\n"
+    "• `/list` - View your files\n"
+    "• `/delete filename` - Remove files\n"
+    "• `/status` - System performance\n\n"
+    "**💎 Premium Performance | Mraprguild**"
+)
+
+STATUS_STATIC = (
+    f"**Max File Size:** {humanbytes(MAX_FILE_SIZE)}\n"
+    f"**Chunk Size:** {humanbytes(CHUNK_SIZE)}\n"
+    f"**Concurrent Workers:** {MAX_WORKERS}\n"
+    f"**Buffer Size:** {humanbytes(BUFFER_SIZE)}\n\n"
+    "**🚀 Performance Optimized**\n"
+    "• Multi-threaded uploads/downloads\n"
+    "• Memory-efficient streaming\n"
+    "• Chunked transfer protocol\n"
+    "• Adaptive speed optimization"
+)
+
+SUCCESS_TEMPLATE = (
+    "✅ **UPLOAD COMPLETE!** ✅\n\n"
+    "📁 **File:** {file_name}\n"
+    "💾 **Size:** {size}\n"
+    "⚡ **Speed:** {speed}/s\n"
+    "⏱️ **Time:** {elapsed}\n"
+    "🔗 **Expires:** 7 days\n\n"
+    "🎬 **Web Player Ready!**"
+)
 
 # Bot Handlers with High-Performance Features
 @app.on_message(filters.command("start"))
@@ -319,53 +640,22 @@ async def start_command(client, message: Message):
     if is_rate_limited(message.from_user.id):
         await message.reply_text("🚫 Too many requests. Please wait a minute.")
         return
-        
-    await message.reply_text(
-        "⚡ **ULTRA HIGH-SPEED CLOUD STORAGE BOT** ⚡\n\n"
-        "✨ **Features:**\n"
-        "• 🚀 **2GB File Support** - Massive uploads/downloads\n"
-        "• ⚡ **Multi-threaded Transfers** - Maximum speed\n"
-        "• 💾 **Memory Optimized** - Efficient large file handling\n"
-        "• 🌐 **Web Player Integration** - Instant media playback\n"
-        "• 🔄 **Resumable Uploads** - Never lose progress\n\n"
-        "**📁 Supported Formats:**\n"
-        "• Videos: MP4, AVI, MKV, MOV, WebM, etc.\n"
-        "• Audio: MP3, FLAC, WAV, AAC, etc.\n"
-        "• Images: JPG, PNG, GIF, WebP, etc.\n"
-        "• Documents: PDF, ZIP, etc.\n\n"
-        "**⚡ Commands:**\n"
-        "• Just send any file to upload\n"
-        "• `/download filename` - High-speed download\n"
-        "• `/play filename` - Web player link\n"
-        "• `/list` - View your files\n"
-        "• `/delete filename` - Remove files\n"
-        "• `/status` - System performance\n\n"
-        "**💎 Premium Performance | Mraprguild**"
-    )
+
+    await message.reply_text(START_TEXT)
 
 @app.on_message(filters.command("status"))
 async def status_command(client, message: Message):
     """System performance status"""
     monitor = PerformanceMonitor()
     memory_usage = monitor.get_memory_usage()
-    
-    status_text = (
+
+    await message.reply_text(
         "⚡ **System Status** ⚡\n\n"
         f"**Memory Usage:** {memory_usage:.1f} MB\n"
-        f"**Max File Size:** {humanbytes(MAX_FILE_SIZE)}\n"
-        f"**Chunk Size:** {humanbytes(CHUNK_SIZE)}\n"
-        f"**Concurrent Workers:** {MAX_WORKERS}\n"
-        f"**Buffer Size:** {humanbytes(BUFFER_SIZE)}\n\n"
-        "**🚀 Performance Optimized**\n"
-        "• Multi-threaded uploads/downloads\n"
-        "• Memory-efficient streaming\n"
-        "• Chunked transfer protocol\n"
-        "• Adaptive speed optimization"
+        + STATUS_STATIC
     )
-    
-    await message.reply_text(status_text)
 
-@app.on_message(filters.document | filters.video | filters.audio | filters.photo)
+@app.on_message(MEDIA_FILTER)
 async def upload_file_handler(client, message: Message):
     if is_rate_limited(message.from_user.id):
         await message.reply_text("🚫 Rate limited. Please wait.")
@@ -378,7 +668,8 @@ async def upload_file_handler(client, message: Message):
 
     # Get file info
     if message.photo:
-        file_size = message.photo.sizes[-1].file_size
+        # Pyrogram v2 photos are a single Photo object, not a size array
+        file_size = message.photo.file_size
         file_name = f"photo_{int(time.time())}.jpg"
     else:
         file_size = media.file_size
@@ -398,7 +689,7 @@ async def upload_file_handler(client, message: Message):
     monitor = PerformanceMonitor()
     status_message = await message.reply_text(
         "🚀 **ULTRA HIGH-SPEED UPLOAD** 🚀\n\n"
-        "📥 Downloading from Telegram...\n"
+        "⚡ Streaming to cloud storage...\n"
         f"📦 File: {file_name}\n"
         f"💾 Size: {humanbytes(file_size)}\n\n"
         "⚡ **Performance Stats:**\n"
@@ -407,119 +698,132 @@ async def upload_file_handler(client, message: Message):
         "• Progress: Initializing..."
     )
 
-    download_start = time.time()
-    last_update = time.time()
-    processed_bytes = 0
-    last_processed = 0
+    upload_start = time.monotonic()
+    progress_state = {'last_update': time.monotonic(), 'last_pct': 0.0, 'last_processed': 0}
+
+    # Latest-wins mailbox consumed by one updater task: progress
+    # callbacks publish text for the cost of a dict store plus an Event
+    # set, and a single coroutine performs edits at most every 2s, so
+    # FloodWait sleeps never block the transfer itself. The Event makes
+    # the updater callback-driven: it parks until progress actually
+    # advances instead of waking on a timer during stalls
+    latest_status = {'text': None}
+    status_dirty = asyncio.Event()
+
+    async def status_updater():
+        last_sent = None
+        while True:
+            await status_dirty.wait()
+            status_dirty.clear()
+            text = latest_status['text']
+            if text is None or text == last_sent:
+                # Re-sending identical text still costs an API call (and
+                # Telegram rejects it with MESSAGE_NOT_MODIFIED), so
+                # dedupe against what was last delivered
+                continue
+            latest_status['text'] = None
+            try:
+                await status_message.edit_text(text)
+                last_sent = text
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+            except Exception:
+                pass
+            # Rate cap stays: at most one edit per 2s however fast new
+            # frames are published
+            await asyncio.sleep(2)
+
+    updater_task = asyncio.create_task(status_updater())
+
+    async def report_progress(current):
+        # Coalescing throttle: edit only when enough time AND progress
+        # have accumulated, so fast backbone uploads cannot trigger
+        # FloodWait stalls from edit_text spam
+        current_time = time.monotonic()
+        time_diff = current_time - progress_state['last_update']
+        percentage = (current / file_size) * 100 if file_size else 100
+        if time_diff < 1.5 or percentage - progress_state['last_pct'] < 1.0:
+            return
+
+        # Calculate speed
+        instant_speed = (current - progress_state['last_processed']) / time_diff
+        monitor.add_speed_sample(instant_speed)
+        avg_speed = monitor.get_average_speed()
+
+        # Calculate ETA
+        elapsed = current_time - upload_start
+        if avg_speed > 0:
+            eta = (file_size - current) / avg_speed
+        else:
+            eta = 0
+
+        # Memory usage
+        memory_usage = monitor.get_memory_usage()
+
+        progress_text = (
+            "🚀 **ULTRA HIGH-SPEED UPLOAD** 🚀\n\n"
+            f"⚡ Streaming: {file_name}\n"
+            f"📊 Progress: {create_progress_bar(percentage)} {percentage:.1f}%\n"
+            f"📦 Transferred: {humanbytes(current)} / {humanbytes(file_size)}\n\n"
+            "⚡ **Performance Stats:**\n"
+            f"• **Speed:** {humanbytes(avg_speed)}/s\n"
+            f"• **Memory:** {memory_usage:.1f} MB\n"
+            f"• **ETA:** {format_eta(eta)}\n"
+            f"• **Elapsed:** {format_elapsed(elapsed)}"
+        )
+
+        latest_status['text'] = progress_text
+        status_dirty.set()
+        progress_state['last_update'] = current_time
+        progress_state['last_pct'] = percentage
+        progress_state['last_processed'] = current
 
     try:
-        # High-speed download with progress
-        download_path = None
-        
-        async for progress_data in download_large_file(client, message, media.file_id, file_size, file_name):
-            if isinstance(progress_data, tuple) and len(progress_data) == 2:
-                current, total = progress_data
-                
-                if isinstance(current, str):  # Download complete
-                    download_path = current
-                    break
-                
-                # Update progress with performance metrics
-                current_time = time.time()
-                time_diff = current_time - last_update
-                
-                if time_diff >= 1.0:  # Update every second
-                    # Calculate speed
-                    instant_speed = (current - last_processed) / time_diff
-                    monitor.add_speed_sample(instant_speed)
-                    avg_speed = monitor.get_average_speed()
-                    
-                    # Calculate ETA
-                    elapsed = current_time - download_start
-                    if avg_speed > 0:
-                        eta = (total - current) / avg_speed
-                    else:
-                        eta = 0
-                    
-                    # Memory usage
-                    memory_usage = monitor.get_memory_usage()
-                    
-                    # Progress percentage
-                    percentage = (current / total) * 100
-                    
-                    progress_text = (
-                        "🚀 **ULTRA HIGH-SPEED UPLOAD** 🚀\n\n"
-                        f"📥 Downloading: {file_name}\n"
-                        f"📊 Progress: {create_progress_bar(percentage)} {percentage:.1f}%\n"
-                        f"📦 Transferred: {humanbytes(current)} / {humanbytes(total)}\n\n"
-                        "⚡ **Performance Stats:**\n"
-                        f"• **Speed:** {humanbytes(avg_speed)}/s\n"
-                        f"• **Memory:** {memory_usage:.1f} MB\n"
-                        f"• **ETA:** {format_eta(eta)}\n"
-                        f"• **Elapsed:** {format_elapsed(elapsed)}"
-                    )
-                    
-                    try:
-                        await status_message.edit_text(progress_text)
-                        last_update = current_time
-                        last_processed = current
-                    except FloodWait as e:
-                        await asyncio.sleep(e.value)
-                    except Exception:
-                        pass
-
-        if not download_path:
-            raise Exception("Download failed")
-
-        # Upload to Wasabi with high-performance method
-        await status_message.edit_text("🚀 **Uploading to Cloud Storage...**")
-        
         user_file_name = f"{get_user_folder(message.from_user.id)}/{sanitize_filename(file_name)}"
-        
-        # Use threaded upload for better performance
-        await asyncio.get_event_loop().run_in_executor(
-            s3_manager.executor,
-            s3_manager.upload_file_chunked,
-            download_path,
-            WASABI_BUCKET,
-            user_file_name
-        )
+
+        # Stream Telegram chunks straight into a Wasabi multipart upload -
+        # no local disk staging, no cleanup pass
+        async with UPLOAD_SEMAPHORE:
+            await s3_manager.upload_stream(
+                client.stream_media(message),
+                WASABI_BUCKET,
+                user_file_name,
+                progress=report_progress
+            )
+
+        # Replicate to backup buckets in the background: the user gets
+        # their link as soon as the primary copy is durable, and the
+        # server-side copies cost no bot egress
+        spawn_background(s3_manager.replicate_to_backups(user_file_name))
+
+        # Final texts below must not race a stale progress edit
+        updater_task.cancel()
 
         # Generate shareable links
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object', 
-            Params={'Bucket': WASABI_BUCKET, 'Key': user_file_name}, 
-            ExpiresIn=604800  # 7 days
-        )
+        presigned_url = await make_presigned(user_file_name)
         
         player_url = generate_player_url(file_name, presigned_url)
         keyboard = create_download_keyboard(presigned_url, player_url)
+
+        total_time = time.monotonic() - upload_start
+        overall_speed = file_size / total_time if total_time else 0
         
-        total_time = time.time() - download_start
-        overall_speed = file_size / total_time
-        
-        success_text = (
-            "✅ **UPLOAD COMPLETE!** ✅\n\n"
-            f"📁 **File:** {file_name}\n"
-            f"💾 **Size:** {humanbytes(file_size)}\n"
-            f"⚡ **Speed:** {humanbytes(overall_speed)}/s\n"
-            f"⏱️ **Time:** {format_elapsed(total_time)}\n"
-            f"🔗 **Expires:** 7 days\n\n"
-            "🎬 **Web Player Ready!**"
-        )
+        success_text = SUCCESS_TEMPLATE.format_map({
+            'file_name': file_name,
+            'size': humanbytes(file_size),
+            'speed': humanbytes(overall_speed),
+            'elapsed': format_elapsed(total_time)
+        })
         
-        await status_message.edit_text(success_text, reply_markup=keyboard)
+        await edit_floodsafe(status_message, success_text, reply_markup=keyboard)
 
     except Exception as e:
+        updater_task.cancel()
         logger.error(f"Upload error: {e}")
         error_text = f"❌ **Upload Failed**\n\n**Error:** {str(e)}\n\nPlease try again with a smaller file or check your connection."
-        await status_message.edit_text(error_text)
+        await edit_floodsafe(status_message, error_text)
     finally:
-        # Cleanup
-        if 'download_path' in locals() and download_path and os.path.exists(download_path):
-            os.path.dirname(download_path)  # Get directory
-            os.remove(download_path)
-            os.rmdir(os.path.dirname(download_path))
+        updater_task.cancel()
 
 # Enhanced download command with high-speed options
 @app.on_message(filters.command("download"))
@@ -528,26 +832,22 @@ async def download_file_handler(client, message: Message):
         await message.reply_text("🚫 Rate limited. Please wait.")
         return
         
-    if len(message.command) < 2:
-        await message.reply_text("❌ Usage: `/download filename`", parse_mode="markdown")
+    # Single C-level partition instead of message.command's split + join
+    file_name = message.text.partition(' ')[2].strip()
+    if not file_name:
+        await message.reply_text("❌ Usage: `/download filename`")
         return
-
-    file_name = " ".join(message.command[1:])
     user_file_name = f"{get_user_folder(message.from_user.id)}/{file_name}"
     
     status_message = await message.reply_text("🚀 Generating high-speed download link...")
     
     try:
         # Check file exists and get size
-        head = s3_client.head_object(Bucket=WASABI_BUCKET, Key=user_file_name)
+        head = await head_object_cached(user_file_name)
         file_size = head['ContentLength']
-        
+
         # Generate presigned URL with longer expiry
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object', 
-            Params={'Bucket': WASABI_BUCKET, 'Key': user_file_name}, 
-            ExpiresIn=604800  # 7 days
-        )
+        presigned_url = await make_presigned(user_file_name)
         
         player_url = generate_player_url(file_name, presigned_url)
         keyboard = create_download_keyboard(presigned_url, player_url)
@@ -564,21 +864,174 @@ async def download_file_handler(client, message: Message):
 
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == '404':
-            await status_message.edit_text("❌ File not found.")
+            # Primary miss: probe every backup bucket concurrently
+            # (1xRTT total instead of a serial scan) and serve from the
+            # first hit
+            fallback = await find_in_backups(user_file_name)
+            if fallback:
+                backup_bucket, head = fallback
+                presigned_url = await s3_manager.client.generate_presigned_url(
+                    'get_object',
+                    Params={'Bucket': backup_bucket, 'Key': user_file_name},
+                    ExpiresIn=604800  # 7 days
+                )
+                player_url = generate_player_url(file_name, presigned_url)
+                keyboard = create_download_keyboard(presigned_url, player_url)
+                await status_message.edit_text(
+                    f"🚀 **DOWNLOAD READY (backup)** 🚀\n\n"
+                    f"📁 **File:** {file_name}\n"
+                    f"💾 **Size:** {humanbytes(head['ContentLength'])}\n"
+                    f"⏰ **Expires:** 7 days",
+                    reply_markup=keyboard
+                )
+            else:
+                await status_message.edit_text("❌ File not found.")
         else:
             await status_message.edit_text(f"❌ S3 Error: {str(e)}")
     except Exception as e:
         logger.error(f"Download error: {e}")
         await status_message.edit_text(f"❌ Error: {str(e)}")
 
-# Start web server in background
+@app.on_message(filters.command("list"))
+async def list_files_handler(client, message: Message):
+    if is_rate_limited(message.from_user.id):
+        await message.reply_text("🚫 Rate limited. Please wait.")
+        return
+
+    prefix = f"{get_user_folder(message.from_user.id)}/"
+
+    try:
+        # Stream pages from the async paginator: memory stays bounded to
+        # one page while counts and totals cover the whole prefix, so
+        # users with >1000 files no longer see silently-truncated numbers
+        paginator = s3_manager.client.get_paginator('list_objects_v2')
+
+        lines = []
+        total_size = 0
+        file_count = 0
+        async for page in paginator.paginate(
+            Bucket=WASABI_BUCKET,
+            Prefix=prefix,
+            PaginationConfig={'PageSize': 1000}
+        ):
+            for obj in page.get('Contents', ()):
+                if len(lines) < 15:
+                    lines.append(f"• `{obj['Key'][len(prefix):]}` - {humanbytes(obj['Size'])}")
+                file_count += 1
+                total_size += obj['Size']
+
+        if not file_count:
+            await message.reply_text("📭 No files stored yet. Send me a file to upload!")
+            return
+
+        if file_count > len(lines):
+            lines.append(f"…and {file_count - len(lines)} more")
+
+        await message.reply_text(
+            "📂 **Your Files:**\n\n" + "\n".join(lines) + "\n\n"
+            f"📦 **Files:** {file_count}\n"
+            f"💾 **Total:** {humanbytes(total_size)}\n"
+            "Use `/download filename` to get a link."
+        )
+
+    except Exception as e:
+        logger.error(f"List error: {e}")
+        await message.reply_text(f"❌ Error: {str(e)}")
+
+@app.on_message(filters.command("delete"))
+async def delete_file_handler(client, message: Message):
+    if is_rate_limited(message.from_user.id):
+        await message.reply_text("🚫 Rate limited. Please wait.")
+        return
+
+    file_name = message.text.partition(' ')[2].strip()
+    if not file_name:
+        await message.reply_text("❌ Usage: `/delete filename`")
+        return
+
+    user_file_name = f"{get_user_folder(message.from_user.id)}/{file_name}"
+    status_message = await message.reply_text("🗑 Deleting...")
+
+    try:
+        # Confirm existence first so a typo gets a clear answer instead
+        # of a silent no-op delete
+        await s3_manager.client.head_object(Bucket=WASABI_BUCKET, Key=user_file_name)
+
+        # The primary delete is the one the user must see fail
+        await s3_manager.client.delete_object(
+            Bucket=WASABI_BUCKET, Key=user_file_name)
+
+        # Backup deletes are best-effort: skip buckets in cooldown and
+        # log per-bucket failures instead of failing the command (a
+        # dead endpoint must not leave the primary copy undeleted)
+        targets = [b for b in WASABI_BACKUP_BUCKETS if backup_available(b)]
+        if targets:
+            results = await asyncio.gather(
+                *[s3_manager.client.delete_object(Bucket=bucket, Key=user_file_name)
+                  for bucket in targets],
+                return_exceptions=True
+            )
+            for bucket, result in zip(targets, results):
+                if isinstance(result, Exception):
+                    backup_down_until[bucket] = time.monotonic() + BACKUP_COOLDOWN
+                    logger.error(f"Backup delete in {bucket} failed: {result}")
+                else:
+                    backup_down_until.pop(bucket, None)
+
+        # Drop stale cache entries so old links are not served
+        presigned_cache.pop(user_file_name, None)
+        head_cache.pop(user_file_name, None)
+
+        await status_message.edit_text(f"✅ **Deleted:** {file_name}")
+
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] == '404':
+            await status_message.edit_text("❌ File not found.")
+        else:
+            await status_message.edit_text(f"❌ S3 Error: {str(e)}")
+    except Exception as e:
+        logger.error(f"Delete error: {e}")
+        await status_message.edit_text(f"❌ Error: {str(e)}")
+
 print("🚀 Starting Ultra High-Speed Cloud Storage Bot...")
 print(f"💾 Max File Size: {humanbytes(MAX_FILE_SIZE)}")
 print(f"⚡ Chunk Size: {humanbytes(CHUNK_SIZE)}")
 print(f"🔧 Workers: {MAX_WORKERS}")
+print(f"🔐 Crypto Backend: {CRYPTO_BACKEND}")
+
+async def main():
+    """Open the shared S3 client for the lifetime of the bot"""
+    try:
+        await run_bot()
+    finally:
+        log_listener.stop()
+
+async def run_bot():
+    async with AsyncExitStack() as stack:
+        s3_manager.client = await stack.enter_async_context(s3_manager.client_context())
+
+        # Web server shares the bot's event loop - no daemon thread, no
+        # cross-thread context switches
+        web_task = asyncio.create_task(serve_web())
+
+        await app.start()
+
+        # Prewarm MTProto and Wasabi sessions so the first upload does
+        # not pay DC connection + TLS handshake latency
+        await app.get_me()
+        logger.info("Telegram DC session warmed up")
+        await asyncio.gather(
+            s3_manager.client.head_bucket(Bucket=WASABI_BUCKET),
+            *[s3_manager.client.head_bucket(Bucket=bucket)
+              for bucket in WASABI_BACKUP_BUCKETS],
+            return_exceptions=True
+        )
+        logger.info("Wasabi connection warmed up")
 
-# Start Flask server in a separate thread
-Thread(target=run_flask_server, daemon=True).start()
+        await idle()
+        await app.stop()
+        web_task.cancel()
+        await asyncio.gather(web_task, return_exceptions=True)
 
 if __name__ == "__main__":
-    app.run()
+    app.run(main())
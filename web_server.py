@@ -1,11 +1,17 @@
 # web_server.py
 import os
 import base64
-from flask import Flask, render_template, request, jsonify
+import asyncio
+import contextlib
+import threading
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from fastapi.templating import Jinja2Templates
+import uvicorn
 from dotenv import load_dotenv
+from cachetools import TTLCache
 import boto3
 import botocore
-from threading import Thread
 import logging
 
 # Load environment variables
@@ -22,21 +28,43 @@ RENDER_URL = os.getenv("RENDER_URL", "http://localhost:8000")
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize S3 client
-s3_client = boto3.client(
-    's3',
-    endpoint_url=f'https://s3.{WASABI_REGION}.wasabisys.com',
-    aws_access_key_id=WASABI_ACCESS_KEY,
-    aws_secret_access_key=WASABI_SECRET_KEY,
-    region_name=WASABI_REGION,
-    config=botocore.config.Config(
-        signature_version='s3v4',
-        retries={'max_attempts': 3}
+# S3 client, built lazily: importing this module (the bot does it for
+# serve_web) should not pay ~25ms of botocore model loading. The lock
+# serializes first-use construction - callers run on Starlette's
+# threadpool and building clients on boto3's default session
+# concurrently is not thread-safe
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def get_s3_client():
+    """Build the S3 client on first use and reuse it afterwards"""
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                _s3_client = _build_s3_client()
+    return _s3_client
+
+def _build_s3_client():
+    return boto3.client(
+        's3',
+        endpoint_url=f'https://s3.{WASABI_REGION}.wasabisys.com',
+        aws_access_key_id=WASABI_ACCESS_KEY,
+        aws_secret_access_key=WASABI_SECRET_KEY,
+        region_name=WASABI_REGION,
+        config=botocore.config.Config(
+            signature_version='s3v4',
+            retries={'max_attempts': 3},
+            max_pool_connections=os.cpu_count() * 5,
+            tcp_keepalive=True
+        )
     )
-)
 
-# Flask app
-app = Flask(__name__, template_folder="templates")
+# ASGI app served on the bot's own event loop. Endpoints that hit S3
+# stay plain `def`: Starlette runs them in its threadpool, so the
+# synchronous boto3 client never blocks the shared loop.
+app = FastAPI()
+templates = Jinja2Templates(directory="templates")
 
 # Media extensions for classification
 MEDIA_EXTENSIONS = {
@@ -65,42 +93,47 @@ def decode_media_url(encoded_url):
         logger.error(f"Error decoding URL: {e}")
         return None
 
-@app.route("/")
-def index():
+@app.get("/")
+async def index(request: Request):
     """Main page with upload/download interface"""
-    return render_template("index.html", render_url=RENDER_URL)
+    return templates.TemplateResponse(
+        request, "index.html", {"render_url": RENDER_URL}
+    )
 
-@app.route("/player/<media_type>/<encoded_url>")
-def player(media_type, encoded_url):
+@app.get("/player/{media_type}/{encoded_url}")
+async def player(request: Request, media_type: str, encoded_url: str):
     """Media player page"""
     media_url = decode_media_url(encoded_url)
     if not media_url:
-        return "Invalid media URL", 400
-    
-    return render_template("player.html", 
-                         media_type=media_type, 
-                         media_url=media_url,
-                         filename=os.path.basename(media_url.split('?')[0]))
-
-@app.route("/browse")
-def browse_files():
+        return JSONResponse({'error': 'Invalid media URL'}, status_code=400)
+
+    return templates.TemplateResponse(
+        request,
+        "player.html",
+        {
+            "media_type": media_type,
+            "media_url": media_url,
+            "filename": os.path.basename(media_url.split('?')[0])
+        }
+    )
+
+@app.get("/browse")
+async def browse_files(request: Request):
     """File browser interface"""
-    return render_template("index.html")
+    return templates.TemplateResponse(request, "index.html")
 
-@app.route("/api/files")
-def list_files():
+@app.get("/api/files")
+def list_files(prefix: str = ''):
     """API endpoint to list user files"""
     try:
         # This would typically require user authentication
         # For now, we'll return a sample or implement basic listing
-        prefix = request.args.get('prefix', '')
-        
-        response = s3_client.list_objects_v2(
+        response = get_s3_client().list_objects_v2(
             Bucket=WASABI_BUCKET,
             Prefix=prefix,
             MaxKeys=50
         )
-        
+
         files = []
         if 'Contents' in response:
             for obj in response['Contents']:
@@ -112,57 +145,92 @@ def list_files():
                     'last_modified': obj['LastModified'].isoformat(),
                     'type': file_type
                 })
-        
-        return jsonify({'files': files})
-    
+
+        return {'files': files}
+
     except Exception as e:
         logger.error(f"Error listing files: {e}")
-        return jsonify({'error': str(e)}), 500
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+# Presigned URLs cached just short of their 1-hour expiry, so repeat
+# requests for the same object skip the HMAC signing work. Endpoints
+# run on Starlette's threadpool and TTLCache is not thread-safe, so
+# every access goes through the lock (signing itself stays outside it)
+_url_cache = TTLCache(maxsize=10_000, ttl=3300)
+_url_cache_lock = threading.Lock()
 
-@app.route("/api/generate-url")
-def generate_download_url():
+@app.get("/api/generate-url")
+def generate_download_url(key: str = ''):
     """Generate presigned URL for download"""
     try:
-        file_key = request.args.get('key')
-        if not file_key:
-            return jsonify({'error': 'Missing file key'}), 400
-        
-        # Generate presigned URL
-        presigned_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': WASABI_BUCKET, 'Key': file_key},
-            ExpiresIn=3600  # 1 hour
-        )
-        
-        return jsonify({'url': presigned_url})
-    
+        if not key:
+            return JSONResponse({'error': 'Missing file key'}, status_code=400)
+
+        with _url_cache_lock:
+            presigned_url = _url_cache.get(key)
+        if presigned_url is None:
+            presigned_url = get_s3_client().generate_presigned_url(
+                'get_object',
+                Params={'Bucket': WASABI_BUCKET, 'Key': key},
+                ExpiresIn=3600  # 1 hour
+            )
+            with _url_cache_lock:
+                _url_cache[key] = presigned_url
+
+        return {'url': presigned_url}
+
     except Exception as e:
         logger.error(f"Error generating URL: {e}")
-        return jsonify({'error': str(e)}), 500
+        return JSONResponse({'error': str(e)}, status_code=500)
 
-@app.route("/health")
+# Health state cached for 30s: monitoring pollers read the last probe
+# result instead of each firing their own head_bucket round-trip. The
+# lock is held across the probe so concurrent pollers on the threadpool
+# wait for one result rather than stacking head_bucket calls (and so
+# the non-thread-safe TTLCache is never mutated concurrently)
+_health_cache = TTLCache(maxsize=1, ttl=30)
+_health_lock = threading.Lock()
+
+@app.get("/health")
 def health_check():
     """Health check endpoint for monitoring"""
-    try:
-        # Test S3 connection
-        s3_client.head_bucket(Bucket=WASABI_BUCKET)
-        return jsonify({'status': 'healthy', 'service': 'web_server'})
-    except Exception as e:
-        logger.error(f"Health check failed: {e}")
-        return jsonify({'status': 'unhealthy', 'error': str(e)}), 503
-
-@app.errorhandler(404)
-def not_found(error):
-    return render_template('404.html'), 404
-
-@app.errorhandler(500)
-def internal_error(error):
-    return render_template('500.html'), 500
-
-def run_flask_server(host="0.0.0.0", port=8000, debug=False):
-    """Run the Flask web server"""
-    logger.info(f"Starting Flask web server on {host}:{port}")
-    app.run(host=host, port=port, debug=debug, threaded=True)
+    with _health_lock:
+        error = _health_cache.get('s3')
+        if error is None:
+            try:
+                # Test S3 connection
+                get_s3_client().head_bucket(Bucket=WASABI_BUCKET)
+                error = ''
+            except Exception as e:
+                logger.error(f"Health check failed: {e}")
+                error = str(e)
+            _health_cache['s3'] = error
+
+    if error:
+        return JSONResponse({'status': 'unhealthy', 'error': error}, status_code=503)
+    return {'status': 'healthy', 'service': 'web_server'}
+
+@app.exception_handler(404)
+async def not_found(request: Request, exc):
+    return templates.TemplateResponse(request, "404.html", status_code=404)
+
+@app.exception_handler(500)
+async def internal_error(request: Request, exc):
+    return templates.TemplateResponse(request, "500.html", status_code=500)
+
+async def serve_web(host="0.0.0.0", port=8000):
+    """Serve the web app on the current event loop (no extra thread).
+
+    serve() wraps itself in capture_signals(), which would grab
+    SIGINT/SIGTERM in the main thread; neuter it so the caller keeps
+    signal ownership (embedded next to the bot, Pyrogram's idle() must
+    see them directly, not re-raised after uvicorn exits).
+    """
+    config = uvicorn.Config(app, host=host, port=port, log_level="info")
+    server = uvicorn.Server(config)
+    server.capture_signals = contextlib.nullcontext
+    logger.info(f"Starting web server on {host}:{port}")
+    await server.serve()
 
 if __name__ == "__main__":
-    run_flask_server()
+    asyncio.run(serve_web())